@@ -0,0 +1,24 @@
+import argparse
+
+
+def main():
+    """Run the blog server"""
+    # Markdown workers re-import this module, so only load the app when actually starting it
+    import uvicorn
+    from app.main import app
+    from app.markdown_cache import clear_cache
+
+    parser = argparse.ArgumentParser(description="Run the blog server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--clean-cache", action="store_true", help="Drop rendered markdown from the disk cache before starting")
+    args = parser.parse_args()
+
+    if args.clean_cache:
+        clear_cache()
+
+    uvicorn.run(app, host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
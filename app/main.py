@@ -1,39 +1,89 @@
-import markdown
 import re
+import hashlib
+import gzip
+import brotli
+from email.utils import formatdate, parsedate_to_datetime
 from functools import lru_cache
 from fastapi import FastAPI, Request
-from fastapi.responses import HTMLResponse, FileResponse
-from fastapi.staticfiles import StaticFiles
+from fastapi.responses import HTMLResponse, Response
 from fastapi.templating import Jinja2Templates
 from pathlib import Path
-from os import listdir, path
+import os
 import time
 import asyncio
-import aiofiles
-from concurrent.futures import ThreadPoolExecutor
+import multiprocessing
+from watchfiles import awatch
+from cachetools import LRUCache
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from app.markdown_cache import parse_markdown_file, init_worker
+from app.precompressed import PrecompressedStaticFiles, precompress_static, preferred_encoding
 
 # Constants
 BLOGS_DIR = Path("blog")
+STATIC_DIR = Path("static")
+FAVICON_PATH = STATIC_DIR / "icons" / "favicon.png"
 IGNORED_FILES = ["about.md"]
 CACHE_DURATION = 60 * 60 * 5 # 5 hours cache
-MAX_WORKERS = 2
+MAX_WORKERS = os.cpu_count() or 1
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+MAX_CACHED_POSTS = 256
+MAX_CACHED_PAGE_BYTES = 64 * 1024 * 1024
+WATCHER_RETRY_DELAY = 30
+SLUG_RE = re.compile(r"[a-z0-9_-]{1,64}")
 
 # Initialize FastAPI
 app = FastAPI()
-app.mount("/static", StaticFiles(directory="static", check_dir=True), name="static")
+static_files = PrecompressedStaticFiles(directory=STATIC_DIR, check_dir=True)
+app.mount("/static", static_files, name="static")
 templates = Jinja2Templates(directory="templates")
 
-# Create thread pool for CPU-bound tasks
-thread_pool = ThreadPoolExecutor(max_workers=MAX_WORKERS)
+# Process pool for CPU-bound markdown parsing, created on startup
+markdown_pool = None
 
 # Cache structures
-blog_content_cache = {}
+blog_content_cache = LRUCache(maxsize=MAX_CACHED_POSTS)
 blog_list_cache = {"content": None, "timestamp": 0}
-blog_page_cache = {}
-about_page_cache = {"content": None, "timestamp": 0}
-
-# File modification tracking
-file_mtimes = {}
+blog_slugs = {}  # lowercased post name -> markdown file name, rebuilt with the post list
+_rendered_cache = {}  # template name -> {"version", "data", "gzip", "br", "etag"}
+blog_page_cache = LRUCache(  # (markdown file name, template name) -> rendered page
+    maxsize=MAX_CACHED_PAGE_BYTES,
+    getsizeof=lambda page: len(page["data"]) + len(page["gzip"]) + len(page["br"]),
+)
+
+# Favicon bytes, loaded once on startup
+favicon_cache = {"data": None, "etag": None}
+
+# Background task invalidating caches when files in BLOGS_DIR change
+blog_watcher = None
+blog_watcher_stop = asyncio.Event()
+
+
+def new_markdown_pool():
+    """Create the markdown worker pool"""
+    # Parsing markdown is pure Python, so threads would just contend for the GIL. Workers are
+    # started from a forkserver because forking this already multi-threaded process can deadlock.
+    # Each worker still re-imports the main module, which is why the entry point lives in the
+    # trivial app/__main__.py rather than here
+    context = multiprocessing.get_context("forkserver")
+    context.set_forkserver_preload(["app.markdown_cache"])
+    return ProcessPoolExecutor(max_workers=MAX_WORKERS, mp_context=context, initializer=init_worker)
+
+
+async def run_in_markdown_pool(func, *args):
+    """Run a function in the markdown pool, replacing the pool once if a worker has died"""
+    global markdown_pool
+    pool = markdown_pool
+    try:
+        return await asyncio.get_event_loop().run_in_executor(pool, func, *args)
+    except BrokenProcessPool:
+        # Concurrent callers share the broken pool, only the first one replaces it
+        if markdown_pool is pool:
+            print("Markdown worker pool broke, starting a new one")
+            pool.shutdown(wait=False)
+            markdown_pool = new_markdown_pool()
+        return await asyncio.get_event_loop().run_in_executor(markdown_pool, func, *args)
 
 
 def is_cache_valid(cache_entry):
@@ -41,57 +91,76 @@ def is_cache_valid(cache_entry):
     return cache_entry and time.time() - cache_entry["timestamp"] < CACHE_DURATION
 
 
-def parse_markdown(content, extensions=None):
-    """Parse markdown content in a separate thread to avoid blocking"""
-    if extensions is None:
-        extensions = ["fenced_code", "nl2br", "meta"]
-    md = markdown.Markdown(extensions=extensions)
-    html = md.convert(content)
-    meta = getattr(md, 'Meta', {}) if hasattr(md, 'Meta') else {}
-    return html, meta
+def render_page(template_name, context):
+    """Render a template to bytes, precompressed copies of them and a strong ETag (CPU-bound, run it in a thread)"""
+    body = templates.get_template(template_name).render(context).encode()
+    return {
+        "data": body,
+        "gzip": gzip.compress(body, compresslevel=GZIP_LEVEL),
+        "br": brotli.compress(body, quality=BROTLI_QUALITY),
+        "etag": hashlib.blake2b(body, digest_size=8).hexdigest(),
+    }
+
+
+def is_not_modified(request: Request, etag, mtime=None):
+    """Check the request's conditional headers against what we would send"""
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        # If-Modified-Since is ignored whenever If-None-Match is present. The comparison is weak,
+        # so tags a proxy marked W/ still match, and "*" matches any current representation
+        tags = [tag.strip() for tag in if_none_match.split(",")]
+        return "*" in tags or etag.removeprefix("W/") in (tag.removeprefix("W/") for tag in tags)
+
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since and mtime is not None:
+        try:
+            return int(mtime) <= parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+    return False
+
+
+def page_response(request: Request, page, max_age, mtime=None, status_code=200):
+    """Serve a rendered page in the client's preferred encoding, or an empty 304 if it already has it"""
+    encoding = preferred_encoding(request)
+
+    # Each encoding is a separate representation, so it gets its own ETag
+    etag = f'"{page["etag"]}-{encoding}"' if encoding else f'"{page["etag"]}"'
+    headers = {"Cache-Control": f"public, max-age={max_age}", "ETag": etag, "Vary": "Accept-Encoding"}
+    if mtime is not None:
+        headers["Last-Modified"] = formatdate(mtime, usegmt=True)
+    if status_code == 200 and is_not_modified(request, etag, mtime):
+        return Response(status_code=304, headers=headers)
+
+    if encoding:
+        headers["Content-Encoding"] = encoding
+        return HTMLResponse(content=page[encoding], status_code=status_code, headers=headers)
+    return HTMLResponse(content=page["data"], status_code=status_code, headers=headers)
 
 
 async def get_blog_content(file_name: str, force_refresh=False):
     """Get blog content with caching"""
     file_path = BLOGS_DIR / file_name
 
-    if not file_path.exists():
-        return None
-
-    mtime = path.getmtime(file_path)
-
+    # Entries are dropped by the watcher when their file changes, so a hit needs no stat
     if not force_refresh and file_name in blog_content_cache:
-        cache_entry = blog_content_cache[file_name]
-        if cache_entry["mtime"] == mtime:
-            return cache_entry["data"]
+        return blog_content_cache[file_name]["data"]
 
     try:
-        # Read file asynchronously
-        async with aiofiles.open(file_path, "r", encoding="utf-8") as f:
-            markdown_content = await f.read()
-
-        # Process markdown in thread pool to avoid blocking the event loop
-        html_content, meta = await asyncio.get_event_loop().run_in_executor(
-            thread_pool, parse_markdown, markdown_content
-        )
-
-        # Create excerpt
-        excerpt = html_content[:300]
-        if len(html_content) > 300:
-            last_space = excerpt.rfind(" ")
-            if last_space != -1:
-                excerpt = excerpt[:last_space] + "..."
-            else:
-                excerpt += "..."
+        mtime = file_path.stat().st_mtime
+    except OSError:
+        return None
 
-        # Remove headings from excerpt
-        excerpt = re.sub(r"<h[1-6]>.*?</h[1-6]>", "", excerpt, flags=re.DOTALL)
+    try:
+        # Read and process markdown in the process pool in one hop to avoid blocking the event loop
+        html_content, meta, excerpt = await run_in_markdown_pool(parse_markdown_file, file_path)
 
         # Prepare result
         result = {
             "excerpt": excerpt,
             "metadata": meta,
             "path": file_name[:-3],
+            "mtime": mtime,
             "html_content": html_content,  # Store full HTML for reuse
         }
 
@@ -108,31 +177,36 @@ async def get_blog_content(file_name: str, force_refresh=False):
         return None
 
 
+def post_slug(file_name: str):
+    """Get the canonical /blog/{name} for a post file, or None if it cannot be served"""
+    path = Path(file_name)
+    slug = path.stem.lower()
+    if path.suffix != ".md" or not SLUG_RE.fullmatch(slug):
+        return None
+    return slug
+
+
 async def get_all_blogs(force_refresh=False):
     """Get all blog posts with caching"""
     current_time = time.time()
 
-    # Check if we need to refresh the cache
+    # File changes are pushed by the watcher, which expires this cache
     refresh_needed = force_refresh or not is_cache_valid(blog_list_cache)
 
-    if not refresh_needed:
-        # Check if any files have been modified
-        for file_path in listdir(BLOGS_DIR):
-            full_path = path.join(BLOGS_DIR, file_path)
-            if path.isfile(full_path) and file_path not in IGNORED_FILES:
-                mtime = path.getmtime(full_path)
-                if file_path not in file_mtimes or file_mtimes[file_path] != mtime:
-                    refresh_needed = True
-                    break
-
     if refresh_needed:
-        # Get list of blog files
-        blog_files = [
-            file_path for file_path in listdir(BLOGS_DIR)
-            if path.isfile(path.join(BLOGS_DIR, file_path)) and file_path not in IGNORED_FILES
-        ]
-
-        # Process all blogs concurrently
+        # Get list of blog files in a single directory pass
+        # Never list a post whose link /blog/{name} would not be served
+        blog_files = []
+        with os.scandir(BLOGS_DIR) as entries:
+            for entry in entries:
+                if not entry.is_file(follow_symlinks=False) or entry.name in IGNORED_FILES:
+                    continue
+                if post_slug(entry.name):
+                    blog_files.append(entry.name)
+                elif entry.name.endswith(".md"):
+                    print(f"Skipping {entry.name}: post names must match {SLUG_RE.pattern}")
+
+        # Submit every file to the process pool at once, each worker reads and parses its own file
         tasks = [get_blog_content(file_name) for file_name in blog_files]
         results = await asyncio.gather(*tasks)
 
@@ -141,146 +215,196 @@ async def get_all_blogs(force_refresh=False):
         blog_list_cache["content"] = content
         blog_list_cache["timestamp"] = current_time
 
-        # Update file modification times
-        for file_path in blog_files:
-            file_mtimes[file_path] = path.getmtime(path.join(BLOGS_DIR, file_path))
+        # Only posts in the list can be served, so unknown names never touch the disk
+        blog_slugs.clear()
+        blog_slugs.update((post_slug(file_name), file_name) for file_name in blog_files)
 
     return blog_list_cache["content"]
 
 
+def invalidate_blog_file(file_name: str):
+    """Drop every cache entry derived from a file in BLOGS_DIR"""
+    blog_content_cache.pop(file_name, None)
+    for cache_key in [key for key in blog_page_cache if key[0] == file_name]:
+        del blog_page_cache[cache_key]
+
+    if file_name not in IGNORED_FILES:
+        blog_list_cache["timestamp"] = 0
+
+
+async def warm_pages():
+    """Render every page that is not already cached, so no request pays for Jinja"""
+    # The list page refreshes the post list, so it has to come first
+    await get_blog_list_page()
+    await asyncio.gather(
+        *[get_md_page(f"{post['path']}.md", "index.html") for post in blog_list_cache["content"]],
+        get_md_page("about.md", "about.html", title="About"),
+    )
+
+
+def invalidate_all_blogs():
+    """Drop every cache entry derived from BLOGS_DIR, for when changes may have gone unreported"""
+    blog_content_cache.clear()
+    blog_page_cache.clear()
+    blog_list_cache["timestamp"] = 0
+
+
+async def watch_blogs():
+    """Invalidate caches as files in BLOGS_DIR are added, changed or removed, restarting the watch if it fails"""
+    restarting = False
+    while not blog_watcher_stop.is_set():
+        # Anything changed while the watch was down was never reported, so reload it all
+        if restarting:
+            invalidate_all_blogs()
+
+        try:
+            async for changes in awatch(BLOGS_DIR, stop_event=blog_watcher_stop):
+                for _, changed_path in changes:
+                    invalidate_blog_file(Path(changed_path).name)
+                try:
+                    await warm_pages()
+                except Exception as e:
+                    print(f"Failed to warm pages: {e}")
+        except Exception as e:
+            print(f"Blog watcher failed, restarting in {WATCHER_RETRY_DELAY}s: {e}")
+
+        if blog_watcher_stop.is_set():
+            break
+
+        # Nothing invalidates the caches until the watch is back, so entries filled meanwhile live one retry at most
+        invalidate_all_blogs()
+        restarting = True
+        try:
+            await asyncio.wait_for(blog_watcher_stop.wait(), timeout=WATCHER_RETRY_DELAY)
+        except asyncio.TimeoutError:
+            pass
+
+
 @app.on_event("startup")
 async def startup_event():
     """Preload blog content on startup"""
+    global blog_watcher, markdown_pool
+    markdown_pool = new_markdown_pool()
+    await asyncio.to_thread(precompress_static, STATIC_DIR)
     await get_all_blogs(force_refresh=True)
-    await about_page(None, preload=True)
+    await warm_pages()
+    try:
+        favicon_cache["data"] = await asyncio.to_thread(FAVICON_PATH.read_bytes)
+        favicon_cache["etag"] = f'"{hashlib.md5(favicon_cache["data"]).hexdigest()}"'
+    except OSError as e:
+        print(f"Failed to load favicon: {e}")
+    blog_watcher_stop.clear()
+    blog_watcher = asyncio.create_task(watch_blogs())
+
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Stop watching BLOGS_DIR and the markdown workers"""
+    # Let the watcher thread exit on its own rather than cancelling it mid-poll
+    blog_watcher_stop.set()
+    if blog_watcher:
+        await blog_watcher
+    if markdown_pool:
+        markdown_pool.shutdown()
+
+
+async def get_blog_list_page():
+    """Get the rendered blog list page, re-rendering only when the post list has been rebuilt"""
+    posts = await get_all_blogs()
+
+    version = blog_list_cache["timestamp"]
+    cached = _rendered_cache.get("blog.html")
+    if not cached or cached["version"] != version:
+        page = await asyncio.to_thread(render_page, "blog.html", {"posts": posts})
+        cached = _rendered_cache["blog.html"] = {"version": version, **page}
+    return cached
 
 
 @app.get("/blog", response_class=HTMLResponse)
 @app.get("/", response_class=HTMLResponse)
 async def blog_list(request: Request):
     """Serve blog list page"""
-    posts = await get_all_blogs()
+    return page_response(request, await get_blog_list_page(), 300)  # 5 minutes browser caching
 
-    response = templates.TemplateResponse(
-        "blog.html",
-        {
-            "request": request,
-            "posts": posts,
-        },
-    )
 
-    # Add cache control headers
-    response.headers["Cache-Control"] = "public, max-age=300"  # 5 minutes browser caching
-
-    return response
-
-
-@app.get("/blog/{filename}", response_class=HTMLResponse)
-async def get_blog(request: Request, filename: str):
-    """Serve individual blog page"""
-    cache_key = f"blog_{filename}"
+async def get_md_page(file_name: str, template: str, title=None):
+    """Get the rendered page showing a single markdown file, with caching"""
+    cache_key = (file_name, template)
 
     # Check cache
-    if cache_key in blog_page_cache and is_cache_valid(blog_page_cache[cache_key]):
-        cached_response = blog_page_cache[cache_key]["data"]
-        # Replace request in cached template
-        cached_response.context["request"] = request
-        return cached_response
-
+    cached = blog_page_cache.get(cache_key)
+    if cached and is_cache_valid(cached):
+        return cached
+
+    blog_data = await get_blog_content(file_name)
+
+    if blog_data:
+        html_content = blog_data["html_content"]
+        mtime = blog_data["mtime"]
+        if title is None:
+            meta_title = blog_data["metadata"].get("title", ["TITLE"])
+            title = meta_title[0] if isinstance(meta_title, list) else meta_title
+    else:
+        html_content = "<p>No blog content found</p>"
+        title = "No blog found"
+        mtime = None
+
+    page = await asyncio.to_thread(render_page, template, {"content": html_content, "title": title})
+    blog_page_cache[cache_key] = {
+        **page,
+        "mtime": mtime,
+        "timestamp": time.time()
+    }
+    return blog_page_cache[cache_key]
+
+
+async def render_md_page(request: Request, file_name: str, template: str, title=None):
+    """Serve a page showing a single markdown file"""
     try:
-        # Get blog content
-        blog_data = await get_blog_content(f"{filename}.md")
-
-        if blog_data:
-            html_content = blog_data["html_content"]
-            meta = blog_data["metadata"]
-            title = meta.get("title", ["TITLE"])[0] if isinstance(meta.get("title", ["TITLE"]), list) else meta.get("title", "TITLE")
-        else:
-            html_content = "<p>No blog content found</p>"
-            title = "No blog found"
-
-        # Create response
-        response = templates.TemplateResponse(
-            "index.html",
-            {
-                "request": request,
-                "content": html_content,
-                "title": title,
-            },
-        )
-
-        response.headers["Cache-Control"] = "public, max-age=3600"  # 1 hour browser caching
-
-        blog_page_cache[cache_key] = {
-            "data": response,
-            "timestamp": time.time()
-        }
-
-        return response
+        page = await get_md_page(file_name, template, title)
+        return page_response(request, page, 3600, page["mtime"])  # 1 hour browser caching
     except Exception as e:
         print(f"Failed in parsing markdown content: {e}")
-        return templates.TemplateResponse(
-            "index.html",
-            {"request": request, "content": "<p>No blog content found</p>", "title": "No blog found"},
+        page = await asyncio.to_thread(
+            render_page, template, {"content": "<p>No blog content found</p>", "title": "No blog found"}
         )
+        return page_response(request, page, 3600)
 
 
-@app.get("/about", response_class=HTMLResponse)
-async def about_page(request: Request, preload=False):
-    """Serve about page"""
-    # For preloading during startup
-    if preload:
-        markdown_file = BLOGS_DIR / "about.md"
-        if markdown_file.exists():
-            mtime = path.getmtime(markdown_file)
-            async with aiofiles.open(markdown_file, "r", encoding="utf-8") as f:
-                markdown_content = await f.read()
-
-            html_content, _ = await asyncio.get_event_loop().run_in_executor(
-                thread_pool, parse_markdown, markdown_content
-            )
-
-            about_page_cache["content"] = html_content
-            about_page_cache["timestamp"] = time.time()
-            about_page_cache["mtime"] = mtime
-        return None
-
-    # Check if we need to refresh the cache
-    refresh_needed = True
-    markdown_file = BLOGS_DIR / "about.md"
-
-    if is_cache_valid(about_page_cache) and markdown_file.exists():
-        mtime = path.getmtime(markdown_file)
-        if mtime == about_page_cache.get("mtime", 0):
-            refresh_needed = False
-
-    if refresh_needed and markdown_file.exists():
-        mtime = path.getmtime(markdown_file)
-        async with aiofiles.open(markdown_file, "r", encoding="utf-8") as f:
-            markdown_content = await f.read()
-
-        html_content, _ = await asyncio.get_event_loop().run_in_executor(
-            thread_pool, parse_markdown, markdown_content
-            )
+async def not_found_response(request: Request):
+    """Serve the missing blog page, rendered once"""
+    page = _rendered_cache.get("not_found")
+    if not page:
+        page = _rendered_cache["not_found"] = await asyncio.to_thread(
+            render_page, "index.html", {"content": "<p>No blog content found</p>", "title": "No blog found"}
+        )
+    return page_response(request, page, 300, status_code=404)
 
-        about_page_cache["content"] = html_content
-        about_page_cache["timestamp"] = time.time()
-        about_page_cache["mtime"] = mtime
 
-    html_content = about_page_cache.get("content", "<p>No content found.</p>")
+@app.get("/blog/{filename}", response_class=HTMLResponse)
+async def get_blog(request: Request, filename: str):
+    """Serve individual blog page"""
+    # Canonicalize the name so different spellings of a post share one cache entry
+    slug = filename.lower()
+    file_name = blog_slugs.get(slug) if SLUG_RE.fullmatch(slug) else None
+    if file_name is None:
+        return await not_found_response(request)
 
-    response = templates.TemplateResponse(
-        "about.html", {"request": request, "content": html_content}
-    )
+    return await render_md_page(request, file_name, "index.html")
 
-    # Add cache control headers
-    response.headers["Cache-Control"] = "public, max-age=3600"  # 1 hour browser caching
 
-    return response
+@app.get("/about", response_class=HTMLResponse)
+async def about_page(request: Request):
+    """Serve about page"""
+    return await render_md_page(request, "about.md", "about.html", title="About")
 
 
 # Serve favicon directly
 @app.get('/favicon.ico', include_in_schema=False)
-async def favicon():
-    return FileResponse('static/favicon.ico')
-
+async def favicon(request: Request):
+    if favicon_cache["data"] is None:
+        return Response(status_code=404)
+    headers = {"ETag": favicon_cache["etag"], "Cache-Control": "public, max-age=31536000, immutable"}
+    if is_not_modified(request, favicon_cache["etag"]):
+        return Response(status_code=304, headers=headers)
+    return Response(favicon_cache["data"], media_type="image/png", headers=headers)
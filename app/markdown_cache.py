@@ -0,0 +1,153 @@
+import contextlib
+import hashlib
+import json
+import os
+import re
+import shutil
+import tempfile
+from pathlib import Path
+
+import markdown_it
+from markdown_it import MarkdownIt
+
+# Constants
+CACHE_DIR = Path(".md-cache")
+EXCERPT_LENGTH = 300
+RENDERER_ID = f"markdown-it-py {markdown_it.__version__} commonmark breaks excerpt={EXCERPT_LENGTH}"
+
+# MultiMarkdown style "Key: value" header lines, as used at the top of every post
+META_RE = re.compile(r"^[ ]{0,3}(?P<key>[A-Za-z0-9_-]+):\s*(?P<value>.*)")
+META_MORE_RE = re.compile(r"^[ ]{4,}(?P<value>.*)")
+META_BEGIN_RE = re.compile(r"^-{3}(\s.*)?")
+META_END_RE = re.compile(r"^(-{3}|\.{3})(\s.*)?")
+
+# Built once per process, rendering keeps no state on the instance between documents
+_md = None
+
+
+def get_markdown() -> MarkdownIt:
+    """Get this process's markdown renderer"""
+    global _md
+    if _md is None:
+        _md = MarkdownIt("commonmark", {"breaks": True}).enable(["fence"])
+    return _md
+
+
+def split_meta(body: str) -> tuple[dict, str]:
+    """Split the header off a document into {key: [values]}, returning the metadata and the remaining markdown"""
+    meta = {}
+    lines = body.split("\n")
+    index = 1 if lines and META_BEGIN_RE.match(lines[0]) else 0
+    key = None
+
+    while index < len(lines):
+        line = lines[index]
+        if not line.strip() or META_END_RE.match(line):
+            index += 1
+            break
+
+        match = META_RE.match(line)
+        if match:
+            key = match.group("key").lower().strip()
+            meta.setdefault(key, []).append(match.group("value").strip())
+        elif key and (match := META_MORE_RE.match(line)):
+            meta[key].append(match.group("value").strip())
+        else:
+            break
+        index += 1
+
+    return meta, "\n".join(lines[index:])
+
+
+def collect_excerpt(tokens, limit=EXCERPT_LENGTH) -> str:
+    """Collect the leading plain text of a parsed document, skipping headings, code blocks and raw html"""
+    parts = []
+    length = 0
+    in_heading = False
+
+    for token in tokens:
+        if token.type == "heading_open":
+            in_heading = True
+        elif token.type == "heading_close":
+            in_heading = False
+        elif token.type == "inline" and not in_heading:
+            text = "".join(
+                " " if child.type in ("softbreak", "hardbreak") else child.content
+                for child in token.children or ()
+                if child.type in ("text", "code_inline", "softbreak", "hardbreak")
+            )
+            text = " ".join(text.split())
+            if not text:
+                continue
+            parts.append(text)
+            length += len(text) + 1
+            if length > limit:
+                break
+
+    excerpt = " ".join(parts)
+    if len(excerpt) > limit:
+        last_space = excerpt.rfind(" ", 0, limit)
+        excerpt = excerpt[:last_space if last_space != -1 else limit] + "..."
+    return excerpt
+
+
+def cache_key(body: str) -> str:
+    """Key a rendered document on its source and the renderer used to render it"""
+    return hashlib.sha256(body.encode() + RENDERER_ID.encode()).hexdigest()[:16]
+
+
+def md_to_html_cached(body: str) -> tuple[str, dict, str]:
+    """Render markdown to html, metadata and a plain text excerpt, reusing a previous render of the same body from disk"""
+    cache_file = CACHE_DIR / f"{cache_key(body)}.json"
+
+    try:
+        with open(cache_file, "r", encoding="utf-8") as f:
+            cached = json.load(f)
+        return cached["html"], cached["meta"], cached["excerpt"]
+    except (OSError, ValueError, KeyError):
+        pass
+
+    # Parse once and build both the html and the excerpt from the same tokens
+    md = get_markdown()
+    meta, content = split_meta(body)
+    env = {}
+    tokens = md.parse(content, env)
+    html = md.renderer.render(tokens, md.options, env)
+    excerpt = collect_excerpt(tokens)
+
+    # Write to a temp file first so concurrent readers never see a partial entry
+    try:
+        CACHE_DIR.mkdir(exist_ok=True)
+        fd, tmp_file = tempfile.mkstemp(dir=CACHE_DIR, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump({"html": html, "meta": meta, "excerpt": excerpt}, f)
+            os.replace(tmp_file, cache_file)
+        except OSError:
+            with contextlib.suppress(OSError):
+                os.remove(tmp_file)
+            raise
+    except OSError as e:
+        print(f"Failed to write markdown cache entry {cache_file}: {e}")
+
+    return html, meta, excerpt
+
+
+def clear_cache():
+    """Remove every rendered document from the disk cache"""
+    shutil.rmtree(CACHE_DIR, ignore_errors=True)
+
+
+def parse_markdown(content):
+    """Parse markdown content, run in a worker process to avoid blocking"""
+    return md_to_html_cached(content)
+
+
+def parse_markdown_file(file_path):
+    """Read and parse a markdown file, small enough that a plain blocking read is cheapest"""
+    return parse_markdown(Path(file_path).read_text(encoding="utf-8"))
+
+
+def init_worker():
+    """Build the markdown renderer once when a worker process starts"""
+    get_markdown()
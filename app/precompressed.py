@@ -0,0 +1,118 @@
+import contextlib
+import gzip
+import mimetypes
+import os
+import tempfile
+
+import brotli
+from fastapi.staticfiles import StaticFiles
+from starlette.datastructures import Headers
+from starlette.requests import Request
+from starlette.responses import FileResponse
+from starlette.staticfiles import NotModifiedResponse
+
+# Constants
+COMPRESSIBLE_SUFFIXES = {".css", ".js", ".svg", ".txt", ".html", ".json", ".ico"}
+SIDECAR_SUFFIXES = {"br": ".br", "gzip": ".gz"}
+
+
+def preferred_encoding(request: Request):
+    """Pick the best precompressed encoding the client accepts, if any"""
+    accepted = set()
+    for item in request.headers.get("accept-encoding", "").split(","):
+        coding, _, params = item.partition(";")
+        params = params.replace(" ", "")
+        if params.startswith("q="):
+            try:
+                if float(params[2:]) == 0:
+                    continue
+            except ValueError:
+                continue
+        accepted.add(coding.strip().lower())
+
+    for encoding in ("br", "gzip"):
+        if encoding in accepted:
+            return encoding
+    return None
+
+
+def precompress_static(directory):
+    """Write .br and .gz sidecars next to every compressible file that lacks an up to date one"""
+    for root, _, files in os.walk(directory):
+        for name in files:
+            if os.path.splitext(name)[1] not in COMPRESSIBLE_SUFFIXES:
+                continue
+
+            source = os.path.join(root, name)
+            try:
+                write_sidecars(source)
+            except OSError as e:
+                print(f"Failed to precompress {source}: {e}")
+
+
+def write_sidecars(source):
+    """Write any missing or stale sidecars for a single file"""
+    source_mtime = os.stat(source).st_mtime
+    data = None
+
+    for encoding, suffix in SIDECAR_SUFFIXES.items():
+        sidecar = source + suffix
+        try:
+            if os.stat(sidecar).st_mtime >= source_mtime:
+                continue
+        except FileNotFoundError:
+            pass
+
+        if data is None:
+            with open(source, "rb") as f:
+                data = f.read()
+
+        # Compression runs once offline, so use the highest levels
+        if encoding == "br":
+            compressed = brotli.compress(data, quality=11)
+        else:
+            compressed = gzip.compress(data, compresslevel=9)
+
+        # Write to a unique temp file first so processes starting together never collide
+        fd, tmp_file = tempfile.mkstemp(dir=os.path.dirname(source), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(compressed)
+            os.replace(tmp_file, sidecar)
+        except OSError:
+            with contextlib.suppress(OSError):
+                os.remove(tmp_file)
+            raise
+
+
+class PrecompressedStaticFiles(StaticFiles):
+    """StaticFiles that serves the .br/.gz sidecars written by precompress_static"""
+
+    def file_response(self, full_path, stat_result, scope, status_code=200):
+        full_path = os.fspath(full_path)
+        if os.path.splitext(full_path)[1] not in COMPRESSIBLE_SUFFIXES:
+            return super().file_response(full_path, stat_result, scope, status_code)
+
+        encoding = preferred_encoding(Request(scope))
+        if encoding:
+            sidecar = full_path + SIDECAR_SUFFIXES[encoding]
+            try:
+                sidecar_stat = os.stat(sidecar)
+            except OSError:
+                sidecar_stat = None
+
+            if sidecar_stat and sidecar_stat.st_mtime >= stat_result.st_mtime:
+                response = FileResponse(
+                    sidecar,
+                    status_code=status_code,
+                    stat_result=sidecar_stat,
+                    media_type=mimetypes.guess_type(full_path)[0],
+                    headers={"Content-Encoding": encoding, "Vary": "Accept-Encoding"},
+                )
+                if self.is_not_modified(response.headers, Headers(scope=scope)):
+                    return NotModifiedResponse(response.headers)
+                return response
+
+        response = super().file_response(full_path, stat_result, scope, status_code)
+        response.headers["Vary"] = "Accept-Encoding"
+        return response